@@ -13,7 +13,6 @@ from typing import Tuple, Mapping, Optional, List, Sequence
 import itertools
 from enum import Enum, unique
 import logging
-import statistics
 import shutil
 import gc
 
@@ -40,7 +39,9 @@ from vkit_open_model.loss_function import (
     AdaptiveScalingPreciseLossFunction,
 )
 from vkit_open_model.training import (
-    batch_to_device,
+    device_is_cuda,
+    align_optimizer_state_memory_format,
+    prefetch_batches_to_device,
     enable_cudnn_benchmark,
     enable_cudnn_deterministic,
     setup_seeds,
@@ -65,6 +66,11 @@ class EpochConfig:
     dev_rng_seed: int = 13
     dev_num_processes: int = 32
     avg_num_batches: int = 50
+    enable_autocast: bool = True
+    # 'bfloat16' or 'float16'. Gradient scaling is enabled for 'float16'.
+    autocast_dtype: str = 'bfloat16'
+    # Let torch.compile capture the compiled model in CUDA graphs.
+    enable_cuda_graph: bool = False
     enable_overfit_testing: bool = False
     enable_multitask_gradiant_inspection: bool = False
 
@@ -78,6 +84,8 @@ class OptimizerConfig:
     cosine_annealing_warm_restarts_tmulti: int = 10
     cosine_annealing_warm_restarts_eta_min: float = 8E-6
     clip_grad_norm_max_norm: Optional[float] = 2.5
+    # Update lr every N batches, the lr changes little within a few batches.
+    optimizer_scheduler_step_interval: int = 4
 
 
 @unique
@@ -104,6 +112,20 @@ class DatasetConfig:
     dev_adaptive_scaling_dataset_steps_json: str
 
 
+def update_metrics_with_loss_buffer(
+    metrics: Metrics,
+    tag: MetricsTag,
+    loss_buffer: List[torch.Tensor],
+):
+    avg_loss = None
+    # NOTE: Only one device-to-host sync for the whole buffer.
+    for loss in torch.stack(loss_buffer).tolist():
+        avg_loss = metrics.update(tag, loss)
+    loss_buffer.clear()
+    assert avg_loss is not None
+    return avg_loss
+
+
 def train(
     dataset_config_json: str,
     output_folder: str,
@@ -274,21 +296,34 @@ def train(
         )
 
     # Model.
+    # NOTE: TorchScript is only used for dumping the model for deployment.
     model = AdaptiveScaling(model_config)
-    model_jit: torch.jit.ScriptModule = torch.jit.script(model)  # type: ignore
-    model_jit = model_jit.to(device)
-    del model
+    # NOTE: NHWC is required by the tensor core conv kernels.
+    model = model.to(device, memory_format=torch.channels_last)  # type: ignore
+
+    compile_mode = 'max-autotune' if epoch_config.enable_cuda_graph \
+        else 'max-autotune-no-cudagraphs'
+    logger.info(f'compile_mode = {compile_mode}')
+    forward_rough = torch.compile(model.forward_rough, mode=compile_mode)  # type: ignore
+    forward_precise = torch.compile(model.forward_precise, mode=compile_mode)  # type: ignore
 
     # Loss.
     rough_loss_function = AdaptiveScalingRoughLossFunction(rough_loss_config)
     precise_loss_function = AdaptiveScalingPreciseLossFunction(precise_loss_config)
 
     # Optimizer.
+    # NOTE: Run the parameter update as multi-tensor kernels instead of per-parameter ones.
+    # The fused implementation is CUDA only.
+    if device_is_cuda(device):
+        adamw_kwargs = {'fused': True}
+    else:
+        adamw_kwargs = {'foreach': True}
     optimizer = torch.optim.AdamW(
-        params=model_jit.parameters(),
+        params=model.parameters(),
         lr=optimizer_config.adamw_lr,
         betas=optimizer_config.adamw_betas,
         weight_decay=optimizer_config.adamw_weight_decay,
+        **adamw_kwargs,
     )
     optimizer_scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(
         optimizer,
@@ -297,6 +332,15 @@ def train(
         eta_min=optimizer_config.cosine_annealing_warm_restarts_eta_min,
     )
 
+    # Mixed precision.
+    enable_autocast = epoch_config.enable_autocast and device_is_cuda(device)
+    autocast_dtype = getattr(torch, epoch_config.autocast_dtype)
+    assert autocast_dtype in (torch.bfloat16, torch.float16)
+    logger.info(f'enable_autocast = {enable_autocast}, autocast_dtype = {autocast_dtype}')
+    grad_scaler = torch.cuda.amp.GradScaler(  # type: ignore
+        enabled=(enable_autocast and autocast_dtype == torch.float16),
+    )
+
     # Metircs.
     metrics = Metrics(MetricsTag, avg_num_batches=epoch_config.avg_num_batches)
 
@@ -311,7 +355,7 @@ def train(
         )
         if restore_epoch_idx:
             epoch_idx = restore_state.epoch_idx + 1
-        model_jit.load_state_dict(restore_state.model_jit_state_dict)
+        model.load_state_dict(restore_state.model_jit_state_dict)
 
         # Patch lr if needed.
         # NOTE: might be more needed to be patched.
@@ -320,6 +364,8 @@ def train(
                 logger.info('Patching initial_lr')
                 param_group['initial_lr'] = optimizer_config.adamw_lr  # type: ignore
         optimizer.load_state_dict(restore_state.optimizer_state_dict)  # type: ignore
+        # Match the channels_last params, required by the fused kernel.
+        align_optimizer_state_memory_format(optimizer)
 
         optimizer_scheduler_state_dict = dict(restore_state.optimizer_scheduler_state_dict)
         if optimizer_scheduler_state_dict['base_lrs'] != [optimizer_config.adamw_lr]:
@@ -344,11 +390,13 @@ def train(
             dev_adaptive_scaling_dataset,
             collate_fn=adaptive_scaling_dataset_collate_fn,
             batch_size=epoch_config.dev_batch_size,
+            pin_memory=device_is_cuda(device),
         )
     train_data_loader = DataLoader(
         train_adaptive_scaling_dataset,
         collate_fn=adaptive_scaling_dataset_collate_fn,
         batch_size=epoch_config.train_batch_size,
+        pin_memory=device_is_cuda(device),
     )
 
     best_dev_loss = float('inf')
@@ -388,70 +436,91 @@ def train(
                 train_adaptive_scaling_dataset,
                 collate_fn=adaptive_scaling_dataset_collate_fn,
                 batch_size=epoch_config.train_batch_size,
+                pin_memory=device_is_cuda(device),
             )
 
         logger.info('Training...')
-        model_jit.train()
+        model.train()
         torch.set_grad_enabled(True)
 
-        for batch_idx, batch in enumerate(train_data_loader, start=1):
+        rough_loss_buffer: List[torch.Tensor] = []
+        precise_loss_buffer: List[torch.Tensor] = []
+
+        for batch_idx, batch in enumerate(
+            prefetch_batches_to_device(
+                train_data_loader,
+                device,
+                key_to_memory_format={'image': torch.channels_last},
+            ),
+            start=1,
+        ):
             # Train rough prediction.
-            rough_batch = batch_to_device(batch['rough'], device)
-            (
-                rough_char_mask_feature,
-                rough_char_height_feature,
-            ) = model_jit.forward_rough(rough_batch['image'])  # type: ignore
-
-            rough_loss = rough_loss_function(
-                rough_char_mask_feature=rough_char_mask_feature,
-                rough_char_height_feature=rough_char_height_feature,
-                downsampled_mask=rough_batch['downsampled_mask'],
-                downsampled_score_map=rough_batch['downsampled_score_map'],
-                downsampled_shape=rough_batch['downsampled_shape'],
-                downsampled_core_box=rough_batch['downsampled_core_box'],
-            )
-            rough_loss /= 2
+            rough_batch = batch.pop('rough')
+            with torch.autocast(
+                device_type=device.type,
+                dtype=autocast_dtype,
+                enabled=enable_autocast,
+            ):
+                (
+                    rough_char_mask_feature,
+                    rough_char_height_feature,
+                ) = forward_rough(rough_batch['image'])
+
+                rough_loss = rough_loss_function(
+                    rough_char_mask_feature=rough_char_mask_feature,
+                    rough_char_height_feature=rough_char_height_feature,
+                    downsampled_mask=rough_batch['downsampled_mask'],
+                    downsampled_score_map=rough_batch['downsampled_score_map'],
+                    downsampled_shape=rough_batch['downsampled_shape'],
+                    downsampled_core_box=rough_batch['downsampled_core_box'],
+                )
+                rough_loss /= 2
 
-            rough_avg_loss = metrics.update(MetricsTag.TRAIN_ROUGH_LOSS, float(rough_loss))
-            rough_loss.backward()
+            rough_loss_buffer.append(rough_loss.detach())
+            grad_scaler.scale(rough_loss).backward()
             del rough_batch
             del rough_loss
 
             rough_name_to_grad = None
             if epoch_config.enable_multitask_gradiant_inspection:
-                rough_name_to_grad = AdaptiveScaling.debug_get_rough_name_to_grad(model_jit)
+                rough_name_to_grad = AdaptiveScaling.debug_get_rough_name_to_grad(model)
 
             # Train precise prediction.
-            precise_batch = batch_to_device(batch['precise'], device)
-            (
-                precise_char_prob_feature,
-                precise_char_up_left_corner_offset_feature,
-                precise_char_corner_angle_feature,
-                precise_char_corner_distance_feature,
-            ) = model_jit.forward_precise(precise_batch['image'])  # type: ignore
-
-            precise_loss = precise_loss_function(
-                precise_char_mask_feature=None,
-                precise_char_prob_feature=precise_char_prob_feature,
-                precise_char_up_left_corner_offset_feature=(
-                    precise_char_up_left_corner_offset_feature
-                ),
-                precise_char_corner_angle_feature=precise_char_corner_angle_feature,
-                precise_char_corner_distance_feature=precise_char_corner_distance_feature,
-                downsampled_char_prob_score_map=precise_batch['downsampled_score_map'],
-                downsampled_char_mask=precise_batch['downsampled_mask'],
-                downsampled_shape=precise_batch['downsampled_shape'],
-                downsampled_core_box=precise_batch['downsampled_core_box'],
-                downsampled_label_point_y=precise_batch['downsampled_label_point_y'],
-                downsampled_label_point_x=precise_batch['downsampled_label_point_x'],
-                char_up_left_offsets=precise_batch['up_left_offsets'],
-                char_corner_angles=precise_batch['corner_angles'],
-                char_corner_distances=precise_batch['corner_distances'],
-            )
-            precise_loss /= 2
+            precise_batch = batch.pop('precise')
+            with torch.autocast(
+                device_type=device.type,
+                dtype=autocast_dtype,
+                enabled=enable_autocast,
+            ):
+                (
+                    precise_char_prob_feature,
+                    precise_char_up_left_corner_offset_feature,
+                    precise_char_corner_angle_feature,
+                    precise_char_corner_distance_feature,
+                ) = forward_precise(precise_batch['image'])
+
+                precise_loss = precise_loss_function(
+                    precise_char_mask_feature=None,
+                    precise_char_prob_feature=precise_char_prob_feature,
+                    precise_char_up_left_corner_offset_feature=(
+                        precise_char_up_left_corner_offset_feature
+                    ),
+                    precise_char_corner_angle_feature=precise_char_corner_angle_feature,
+                    precise_char_corner_distance_feature=precise_char_corner_distance_feature,
+                    downsampled_char_prob_score_map=precise_batch['downsampled_score_map'],
+                    downsampled_char_mask=precise_batch['downsampled_mask'],
+                    downsampled_shape=precise_batch['downsampled_shape'],
+                    downsampled_core_box=precise_batch['downsampled_core_box'],
+                    downsampled_label_point_y=precise_batch['downsampled_label_point_y'],
+                    downsampled_label_point_x=precise_batch['downsampled_label_point_x'],
+                    char_up_left_offsets=precise_batch['up_left_offsets'],
+                    char_corner_angles=precise_batch['corner_angles'],
+                    char_corner_distances=precise_batch['corner_distances'],
+                )
+                precise_loss /= 2
 
-            precise_avg_loss = metrics.update(MetricsTag.TRAIN_PRECISE_LOSS, float(precise_loss))
-            precise_loss.backward()
+            precise_loss_buffer.append(precise_loss.detach())
+            grad_scaler.scale(precise_loss).backward()
             del precise_batch
             del precise_loss
 
@@ -459,25 +528,41 @@ def train(
             if epoch_config.enable_multitask_gradiant_inspection:
                 assert rough_name_to_grad is not None
                 precise_name_to_grad = \
-                    AdaptiveScaling.debug_get_precise_name_to_grad(model_jit, rough_name_to_grad)
+                    AdaptiveScaling.debug_get_precise_name_to_grad(model, rough_name_to_grad)
 
                 AdaptiveScaling.debug_inspect_name_to_grad(rough_name_to_grad, precise_name_to_grad)
                 del rough_name_to_grad
                 del precise_name_to_grad
 
             if optimizer_config.clip_grad_norm_max_norm is not None:
+                # NOTE: Clip the unscaled gradients.
+                grad_scaler.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(  # type: ignore
-                    model_jit.parameters(),
+                    model.parameters(),
                     optimizer_config.clip_grad_norm_max_norm,
+                    # Multi-tensor norm computation & scaling, requires torch >= 2.0.
+                    foreach=True,
                 )
 
-            optimizer.step()
-            optimizer_scheduler.step(
-                epoch_idx + (batch_idx - 1) / epoch_config.train_num_batches  # type: ignore
-            )
-            optimizer.zero_grad()
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
+            if (batch_idx - 1) % optimizer_config.optimizer_scheduler_step_interval == 0:
+                optimizer_scheduler.step(
+                    epoch_idx + (batch_idx - 1) / epoch_config.train_num_batches  # type: ignore
+                )
+            optimizer.zero_grad(set_to_none=True)
 
             if batch_idx % 4 == 0 or batch_idx >= epoch_config.train_num_batches:
+                rough_avg_loss = update_metrics_with_loss_buffer(
+                    metrics,
+                    MetricsTag.TRAIN_ROUGH_LOSS,
+                    rough_loss_buffer,
+                )
+                precise_avg_loss = update_metrics_with_loss_buffer(
+                    metrics,
+                    MetricsTag.TRAIN_PRECISE_LOSS,
+                    precise_loss_buffer,
+                )
                 logger.info(
                     f'E={epoch_idx}, '
                     f'B={batch_idx}/{epoch_config.train_num_batches}, '
@@ -488,86 +573,117 @@ def train(
                 )
 
         logger.info('Evaluating...')
-        model_jit.eval()
-        torch.set_grad_enabled(False)
+        model.eval()
         metrics.reset([MetricsTag.DEV_ROUGH_LOSS, MetricsTag.DEV_PRECISE_LOSS])
 
-        dev_rough_losses: List[float] = []
-        dev_precise_losses: List[float] = []
-        dev_losses: List[float] = []
+        rough_loss_buffer: List[torch.Tensor] = []
+        precise_loss_buffer: List[torch.Tensor] = []
 
         assert dev_data_loader is not None
-        for batch_idx, batch in enumerate(dev_data_loader, start=1):
-            # Evaluate rough prediction.
-            rough_batch = batch_to_device(batch['rough'], device)
-            (
-                rough_char_mask_feature,
-                rough_char_height_feature,
-            ) = model_jit.forward_rough(rough_batch['image'])  # type: ignore
-
-            rough_loss = rough_loss_function(
-                rough_char_mask_feature=rough_char_mask_feature,
-                rough_char_height_feature=rough_char_height_feature,
-                downsampled_mask=rough_batch['downsampled_mask'],
-                downsampled_score_map=rough_batch['downsampled_score_map'],
-                downsampled_shape=rough_batch['downsampled_shape'],
-                downsampled_core_box=rough_batch['downsampled_core_box'],
-            )
-            rough_loss = float(rough_loss)
-            rough_loss /= 2
-
-            rough_avg_loss = metrics.update(MetricsTag.DEV_ROUGH_LOSS, float(rough_loss))
-            del rough_batch
-
-            # Evaluate precise prediction.
-            precise_batch = batch_to_device(batch['precise'], device)
-            (
-                precise_char_prob_feature,
-                precise_char_up_left_corner_offset_feature,
-                precise_char_corner_angle_feature,
-                precise_char_corner_distance_feature,
-            ) = model_jit.forward_precise(precise_batch['image'])  # type: ignore
-
-            precise_loss = precise_loss_function(
-                precise_char_mask_feature=None,
-                precise_char_prob_feature=precise_char_prob_feature,
-                precise_char_up_left_corner_offset_feature=(
-                    precise_char_up_left_corner_offset_feature
+        # NOTE: Disable autograd tracking completely.
+        with torch.inference_mode():
+            # NOTE: Accumulate on device to avoid syncing per batch.
+            dev_rough_loss_sum = torch.zeros((), device=device)
+            dev_precise_loss_sum = torch.zeros((), device=device)
+            dev_num_batches = 0
+
+            for batch_idx, batch in enumerate(
+                prefetch_batches_to_device(
+                    dev_data_loader,
+                    device,
+                    key_to_memory_format={'image': torch.channels_last},
                 ),
-                precise_char_corner_angle_feature=precise_char_corner_angle_feature,
-                precise_char_corner_distance_feature=precise_char_corner_distance_feature,
-                downsampled_char_prob_score_map=precise_batch['downsampled_score_map'],
-                downsampled_char_mask=precise_batch['downsampled_mask'],
-                downsampled_shape=precise_batch['downsampled_shape'],
-                downsampled_core_box=precise_batch['downsampled_core_box'],
-                downsampled_label_point_y=precise_batch['downsampled_label_point_y'],
-                downsampled_label_point_x=precise_batch['downsampled_label_point_x'],
-                char_up_left_offsets=precise_batch['up_left_offsets'],
-                char_corner_angles=precise_batch['corner_angles'],
-                char_corner_distances=precise_batch['corner_distances'],
-            )
-            precise_loss = float(precise_loss)
-            precise_loss /= 2
-
-            precise_avg_loss = metrics.update(MetricsTag.DEV_PRECISE_LOSS, float(precise_loss))
-            del precise_batch
-
-            if batch_idx % 4 == 0 or batch_idx >= epoch_config.dev_num_batches:
-                logger.info(
-                    f'E={epoch_idx}, '
-                    f'B={batch_idx}/{epoch_config.dev_num_batches}, '
-                    f'L_rough={rough_avg_loss:.5f}, '
-                    f'L_precise={precise_avg_loss:.5f}, '
-                    f'L_sum={rough_avg_loss + precise_avg_loss:.5f}, '
-                )
-
-            dev_rough_losses.append(rough_loss)
-            dev_precise_losses.append(precise_loss)
-            dev_losses.append(rough_loss + precise_loss)
-
-        dev_rough_loss = statistics.mean(dev_rough_losses)
-        dev_precise_loss = statistics.mean(dev_precise_losses)
-        dev_loss = statistics.mean(dev_losses)
+                start=1,
+            ):
+                # Evaluate rough prediction.
+                rough_batch = batch.pop('rough')
+                with torch.autocast(
+                    device_type=device.type,
+                    dtype=autocast_dtype,
+                    enabled=enable_autocast,
+                ):
+                    (
+                        rough_char_mask_feature,
+                        rough_char_height_feature,
+                    ) = forward_rough(rough_batch['image'])
+
+                    rough_loss = rough_loss_function(
+                        rough_char_mask_feature=rough_char_mask_feature,
+                        rough_char_height_feature=rough_char_height_feature,
+                        downsampled_mask=rough_batch['downsampled_mask'],
+                        downsampled_score_map=rough_batch['downsampled_score_map'],
+                        downsampled_shape=rough_batch['downsampled_shape'],
+                        downsampled_core_box=rough_batch['downsampled_core_box'],
+                    )
+                    rough_loss /= 2
+
+                rough_loss_buffer.append(rough_loss)
+                del rough_batch
+
+                # Evaluate precise prediction.
+                precise_batch = batch.pop('precise')
+                with torch.autocast(
+                    device_type=device.type,
+                    dtype=autocast_dtype,
+                    enabled=enable_autocast,
+                ):
+                    (
+                        precise_char_prob_feature,
+                        precise_char_up_left_corner_offset_feature,
+                        precise_char_corner_angle_feature,
+                        precise_char_corner_distance_feature,
+                    ) = forward_precise(precise_batch['image'])
+
+                    precise_loss = precise_loss_function(
+                        precise_char_mask_feature=None,
+                        precise_char_prob_feature=precise_char_prob_feature,
+                        precise_char_up_left_corner_offset_feature=(
+                            precise_char_up_left_corner_offset_feature
+                        ),
+                        precise_char_corner_angle_feature=precise_char_corner_angle_feature,
+                        precise_char_corner_distance_feature=precise_char_corner_distance_feature,
+                        downsampled_char_prob_score_map=precise_batch['downsampled_score_map'],
+                        downsampled_char_mask=precise_batch['downsampled_mask'],
+                        downsampled_shape=precise_batch['downsampled_shape'],
+                        downsampled_core_box=precise_batch['downsampled_core_box'],
+                        downsampled_label_point_y=precise_batch['downsampled_label_point_y'],
+                        downsampled_label_point_x=precise_batch['downsampled_label_point_x'],
+                        char_up_left_offsets=precise_batch['up_left_offsets'],
+                        char_corner_angles=precise_batch['corner_angles'],
+                        char_corner_distances=precise_batch['corner_distances'],
+                    )
+                    precise_loss /= 2
+
+                precise_loss_buffer.append(precise_loss)
+                del precise_batch
+
+                dev_rough_loss_sum += rough_loss
+                dev_precise_loss_sum += precise_loss
+                dev_num_batches += 1
+
+                if batch_idx % 4 == 0 or batch_idx >= epoch_config.dev_num_batches:
+                    rough_avg_loss = update_metrics_with_loss_buffer(
+                        metrics,
+                        MetricsTag.DEV_ROUGH_LOSS,
+                        rough_loss_buffer,
+                    )
+                    precise_avg_loss = update_metrics_with_loss_buffer(
+                        metrics,
+                        MetricsTag.DEV_PRECISE_LOSS,
+                        precise_loss_buffer,
+                    )
+                    logger.info(
+                        f'E={epoch_idx}, '
+                        f'B={batch_idx}/{epoch_config.dev_num_batches}, '
+                        f'L_rough={rough_avg_loss:.5f}, '
+                        f'L_precise={precise_avg_loss:.5f}, '
+                        f'L_sum={rough_avg_loss + precise_avg_loss:.5f}, '
+                    )
+
+        assert dev_num_batches > 0
+        dev_rough_loss = (dev_rough_loss_sum / dev_num_batches).item()
+        dev_precise_loss = (dev_precise_loss_sum / dev_num_batches).item()
+        dev_loss = dev_rough_loss + dev_precise_loss
         logger.info(
             f'E={epoch_idx}, '
             f'dev_rough_loss = {dev_rough_loss}, '
@@ -596,11 +712,12 @@ def train(
 
             restore_state = RestoreState(
                 epoch_idx=epoch_idx,
-                model_jit_state_dict=model_jit.state_dict(),
+                model_jit_state_dict=model.state_dict(),
                 optimizer_state_dict=optimizer.state_dict(),
                 optimizer_scheduler_state_dict=optimizer_scheduler.state_dict(),
             )
-            torch.save(cattrs.unstructure(restore_state), state_dict_path)
+            # NOTE: Shallow conversion, the state dicts are already mappings of tensors.
+            torch.save(attrs.asdict(restore_state, recurse=False), state_dict_path)
 
         epoch_idx += 1
 
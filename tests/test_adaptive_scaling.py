@@ -98,6 +98,10 @@ def test_get_label_point_feature():
         label_point_x=label_point_x,
     )
     assert label_point_feature.shape == (2, 20, 4)
+    assert torch.equal(
+        label_point_feature,
+        feature[torch.arange(2)[:, None], :, label_point_y, label_point_x],
+    )
 
 
 def profile_adaptive_scaling_jit_forward():
@@ -176,6 +180,69 @@ def test_adaptive_scaling_jit_loss_backward():
     AdaptiveScaling.debug_inspect_name_to_grad(rough_name_to_grad, precise_name_to_grad)
 
 
+def test_adaptive_scaling_channels_last_loss_backward():
+    model = AdaptiveScaling(AdaptiveScalingConfig(AdaptiveScalingSize.TINY))
+    model = model.to(memory_format=torch.channels_last)  # type: ignore
+
+    loss_function = AdaptiveScalingRoughLossFunction(AdaptiveScalingRoughLossFunctionConifg())
+
+    x = torch.randint(low=0, high=256, size=(2, 3, 320, 320)).to(torch.float32)
+    x = x.contiguous(memory_format=torch.channels_last)
+    (
+        rough_char_mask_feature,
+        rough_char_height_feature,
+    ) = model.forward_rough(x)
+
+    loss = loss_function(
+        rough_char_mask_feature=rough_char_mask_feature,
+        rough_char_height_feature=rough_char_height_feature,
+        downsampled_mask=(torch.rand(2, 140, 140) > 0.5).float(),
+        downsampled_score_map=torch.rand(2, 140, 140) + 8.75,
+        downsampled_shape=(160, 160),
+        downsampled_core_box=Box(up=10, down=149, left=10, right=149),
+    )
+    loss.backward()
+
+    rough_name_to_grad = AdaptiveScaling.debug_get_rough_name_to_grad(model)
+    assert any(
+        grad.dim() == 4 and not grad.is_contiguous() for grad in rough_name_to_grad.values()
+    )
+
+    loss_function = AdaptiveScalingPreciseLossFunction(AdaptiveScalingPreciseLossFunctionConifg())
+
+    x = torch.randint(low=0, high=256, size=(2, 3, 320, 320)).to(torch.float32)
+    x = x.contiguous(memory_format=torch.channels_last)
+    (
+        precise_char_prob_feature,
+        precise_char_up_left_corner_offset_feature,
+        precise_char_corner_angle_feature,
+        precise_char_corner_distance_feature,
+    ) = model.forward_precise(x)
+
+    loss = loss_function(
+        precise_char_mask_feature=None,
+        precise_char_prob_feature=precise_char_prob_feature,
+        precise_char_up_left_corner_offset_feature=precise_char_up_left_corner_offset_feature,
+        precise_char_corner_angle_feature=precise_char_corner_angle_feature,
+        precise_char_corner_distance_feature=precise_char_corner_distance_feature,
+        downsampled_char_prob_score_map=torch.rand(2, 140, 140),
+        downsampled_shape=(160, 160),
+        downsampled_core_box=Box(up=10, down=149, left=10, right=149),
+        downsampled_char_mask=(torch.rand(2, 140, 140) > 0.5).float(),
+        downsampled_label_point_y=torch.randint(low=10, high=150, size=(2, 20)),
+        downsampled_label_point_x=torch.randint(low=10, high=150, size=(2, 20)),
+        char_up_left_offsets=torch.randint(low=-20, high=21, size=(2, 20, 2)),
+        char_corner_angles=torch.rand((2, 20, 4)),
+        char_corner_distances=torch.rand((2, 20, 3)),
+    )
+    loss.backward()
+
+    precise_name_to_grad = \
+        AdaptiveScaling.debug_get_precise_name_to_grad(model, rough_name_to_grad)
+
+    AdaptiveScaling.debug_inspect_name_to_grad(rough_name_to_grad, precise_name_to_grad)
+
+
 def sample_adaptive_scaling_dataset(
     num_processes: int,
     num_page_char_regression_labels: int,
@@ -12,12 +12,19 @@
 from typing import List
 from enum import Enum, unique
 import math
+import io
 
+import pytest
 import torch
 from torch.utils.data import IterableDataset, DataLoader, get_worker_info
 from numpy.random import default_rng
 
-from vkit_open_model.training import Metrics, setup_seeds
+from vkit_open_model.training import (
+    Metrics,
+    setup_seeds,
+    align_optimizer_state_memory_format,
+    prefetch_batches_to_device,
+)
 
 
 @unique
@@ -54,6 +61,120 @@ class TestIterableDataset(IterableDataset):
         self.epoch_idx += 1
 
 
+def test_prefetch_batches_to_device():
+    batches = [
+        {
+            'foo': {
+                'image': torch.rand((2, 3, 4, 4)),
+                'shape': (4, 4),
+            },
+        } for _ in range(3)
+    ]
+    device_batches = list(
+        prefetch_batches_to_device(
+            batches,
+            torch.device('cpu'),
+            key_to_memory_format={'image': torch.channels_last},
+        )
+    )
+    assert len(device_batches) == 3
+    for batch, device_batch in zip(batches, device_batches):
+        assert torch.equal(batch['foo']['image'], device_batch['foo']['image'])
+        assert device_batch['foo']['image'].is_contiguous(memory_format=torch.channels_last)
+        assert device_batch['foo']['shape'] == (4, 4)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA is not available.')
+def test_prefetch_batches_to_device_cuda():
+    num_batches = 4
+    images = [torch.rand((2, 3, 4, 4)).pin_memory() for _ in range(num_batches)]
+    num_pulled_batches = 0
+
+    def generate_batches():
+        nonlocal num_pulled_batches
+        for image in images:
+            num_pulled_batches += 1
+            yield {'foo': {'image': image, 'shape': (4, 4)}}
+
+    device = torch.device('cuda')
+    for batch_idx, device_batch in enumerate(
+        prefetch_batches_to_device(
+            generate_batches(),
+            device,
+            key_to_memory_format={'image': torch.channels_last},
+        )
+    ):
+        # The next batch should have been issued before yielding the current one.
+        assert num_pulled_batches == min(batch_idx + 2, num_batches)
+
+        device_image = device_batch['foo']['image']
+        assert device_image.device.type == 'cuda'
+        assert device_image.is_contiguous(memory_format=torch.channels_last)
+        assert device_batch['foo']['shape'] == (4, 4)
+        # Consume in the current stream.
+        assert torch.equal((device_image * 2).cpu(), images[batch_idx] * 2)
+
+    assert num_pulled_batches == num_batches
+
+
+@pytest.mark.parametrize(
+    'device_value',
+    [
+        'cpu',
+        pytest.param(
+            'cuda',
+            marks=pytest.mark.skipif(
+                not torch.cuda.is_available(),
+                reason='CUDA is not available.',
+            ),
+        ),
+    ],
+)
+def test_align_optimizer_state_memory_format(device_value: str):
+    device = torch.device(device_value)
+    adamw_kwargs = {'fused': True} if device.type == 'cuda' else {'foreach': True}
+
+    # Checkpoint of a contiguous model.
+    model = torch.nn.Conv2d(3, 4, kernel_size=3).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), **adamw_kwargs)
+    model(torch.rand((2, 3, 8, 8), device=device)).sum().backward()
+    optimizer.step()
+    buffer = io.BytesIO()
+    torch.save(
+        {
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+        },
+        buffer,
+    )
+    buffer.seek(0)
+    state_dict = torch.load(buffer, map_location='cpu')
+
+    # Restore to a channels_last model.
+    model = torch.nn.Conv2d(3, 4, kernel_size=3)
+    model = model.to(device, memory_format=torch.channels_last)  # type: ignore
+    model.load_state_dict(state_dict['model'])
+    optimizer = torch.optim.AdamW(model.parameters(), **adamw_kwargs)
+    optimizer.load_state_dict(state_dict['optimizer'])
+
+    weight_state = optimizer.state[model.weight]
+    assert weight_state['exp_avg'].stride() != model.weight.stride()
+
+    align_optimizer_state_memory_format(optimizer)
+    # Optimizer state dict is indexed by the order of params.
+    for param_idx, param in enumerate(model.parameters()):
+        for key in ('exp_avg', 'exp_avg_sq'):
+            val = optimizer.state[param][key]
+            assert val.stride() == param.stride()
+            assert torch.equal(val.cpu(), state_dict['optimizer']['state'][param_idx][key])
+
+    # Should be able to continue.
+    model(
+        torch.rand((2, 3, 8, 8), device=device).contiguous(memory_format=torch.channels_last)
+    ).sum().backward()
+    optimizer.step()
+
+
 def test_rng_seeding():
     setup_seeds(torch_seed=42)
 
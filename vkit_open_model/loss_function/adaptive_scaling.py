@@ -35,6 +35,37 @@ class AdaptiveScalingRoughLossFunctionConifg:
     char_height_feature_min: float = 1.1
 
 
+@torch.jit.script
+def compute_rough_l1_mask_and_logs(
+    # (B, CH, CW)
+    rough_char_height_feature: torch.Tensor,
+    downsampled_score_map: torch.Tensor,
+    downsampled_mask: torch.Tensor,
+    char_height_feature_min: float,
+    downsampled_score_map_min: float,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # NOTE: Scripted so that the pointwise ops could be fused into a single kernel.
+    # NOTE: critical mask!
+    l1_mask = ((rough_char_height_feature > char_height_feature_min)
+               & (downsampled_score_map > downsampled_score_map_min)
+               & downsampled_mask.bool()).float()
+    # Log space to model the relative scale difference.
+    # NOTE: Always in float32 since autocast is not applied to scripted functions.
+    log_rough_char_height_feature = torch.log(
+        torch.clamp(
+            rough_char_height_feature.float(),
+            min=char_height_feature_min,
+        )
+    )
+    log_downsampled_score_map = torch.log(
+        torch.clamp(
+            downsampled_score_map.float(),
+            min=downsampled_score_map_min,
+        )
+    )
+    return l1_mask, log_rough_char_height_feature, log_downsampled_score_map
+
+
 class AdaptiveScalingRoughLossFunction:
 
     def __init__(self, config: AdaptiveScalingRoughLossFunctionConifg):
@@ -72,18 +103,19 @@ class AdaptiveScalingRoughLossFunction:
         rough_char_height_feature = torch.squeeze(rough_char_height_feature, dim=1)
 
         # (B, CH, CW)
-        dc_box = downsampled_core_box
-
-        rough_char_mask_feature = rough_char_mask_feature[
-            :,
-            dc_box.up:dc_box.down + 1,
-            dc_box.left:dc_box.right + 1
-        ]  # yapf: disable
-        rough_char_height_feature = rough_char_height_feature[
-            :,
-            dc_box.up:dc_box.down + 1,
-            dc_box.left:dc_box.right + 1
-        ]  # yapf: disable
+        # NOTE: Make contiguous for the following pointwise kernels.
+        dc_up = downsampled_core_box.up
+        dc_down = downsampled_core_box.down + 1
+        dc_left = downsampled_core_box.left
+        dc_right = downsampled_core_box.right + 1
+
+        rough_char_mask_feature = \
+            rough_char_mask_feature[:, dc_up:dc_down, dc_left:dc_right].contiguous()
+        rough_char_height_feature = \
+            rough_char_height_feature[:, dc_up:dc_down, dc_left:dc_right].contiguous()
+
+        # NOTE: Materialized lazily and shared by the probability consumers.
+        rough_char_mask_feature_sigmoid: Optional[torch.Tensor] = None
 
         loss = 0.0
 
@@ -100,30 +132,32 @@ class AdaptiveScalingRoughLossFunction:
                 gt=downsampled_mask,
             )
 
+        # NOTE: BCE & focal consume the logits directly.
         if self.config.dice_factor > 0.0:
+            if rough_char_mask_feature_sigmoid is None:
+                rough_char_mask_feature_sigmoid = torch.sigmoid(rough_char_mask_feature)
             loss += self.config.dice_factor * self.dice(
-                pred=torch.sigmoid(rough_char_mask_feature),
+                pred=rough_char_mask_feature_sigmoid,
                 gt=downsampled_mask,
             )
 
         # Scale.
         if self.config.l1_factor > 0.0:
-            # NOTE: critical mask!
-            l1_mask = ((rough_char_height_feature > self.config.char_height_feature_min)
-                       & (downsampled_score_map > self.config.downsampled_score_map_min)
-                       & downsampled_mask.bool()).float()
-            rough_char_height_feature = torch.clamp(
-                rough_char_height_feature,
-                min=self.config.char_height_feature_min,
-            )
-            downsampled_score_map = torch.clamp(
-                downsampled_score_map,
-                min=self.config.downsampled_score_map_min,
+            (
+                l1_mask,
+                log_rough_char_height_feature,
+                log_downsampled_score_map,
+            ) = compute_rough_l1_mask_and_logs(
+                rough_char_height_feature=rough_char_height_feature,
+                downsampled_score_map=downsampled_score_map,
+                downsampled_mask=downsampled_mask,
+                char_height_feature_min=self.config.char_height_feature_min,
+                downsampled_score_map_min=self.config.downsampled_score_map_min,
             )
             # Log space + smooth L1 to model the relative scale difference.
             loss += self.config.l1_factor * self.l1(
-                pred=torch.log(rough_char_height_feature),
-                gt=torch.log(downsampled_score_map),
+                pred=log_rough_char_height_feature,
+                gt=log_downsampled_score_map,
                 mask=l1_mask,
             )
 
@@ -173,10 +207,14 @@ class AdaptiveScalingPreciseLossFunction:
         label_point_y: torch.Tensor,
         label_point_x: torch.Tensor,
     ):
-        batch_size = feature.shape[0]
+        batch_size, num_channels, _, width = feature.shape
         assert batch_size == label_point_y.shape[0] == label_point_x.shape[0]
+        # (B, *, H * W)
+        feature = torch.flatten(feature, start_dim=2)
+        # (B, *, P)
+        index = (label_point_y * width + label_point_x).unsqueeze(1).expand(-1, num_channels, -1)
         # (B, P, *)
-        return feature[torch.arange(batch_size)[:, None], :, label_point_y, label_point_x]
+        return torch.gather(feature, dim=2, index=index).transpose(1, 2)
 
     def __call__(
         self,
@@ -218,17 +256,17 @@ class AdaptiveScalingPreciseLossFunction:
         precise_char_prob_feature = torch.squeeze(precise_char_prob_feature, dim=1)
 
         # (B, CH, CW)
+        # NOTE: Make contiguous for the following pointwise kernels.
+        dc_up = downsampled_core_box.up
+        dc_down = downsampled_core_box.down + 1
+        dc_left = downsampled_core_box.left
+        dc_right = downsampled_core_box.right + 1
+
         if precise_char_mask_feature is not None:
-            precise_char_mask_feature = precise_char_mask_feature[
-                :,
-                downsampled_core_box.up:downsampled_core_box.down + 1,
-                downsampled_core_box.left:downsampled_core_box.right + 1
-            ]  # yapf: disable
-        precise_char_prob_feature = precise_char_prob_feature[
-            :,
-            downsampled_core_box.up:downsampled_core_box.down + 1,
-            downsampled_core_box.left:downsampled_core_box.right + 1
-        ]  # yapf: disable
+            precise_char_mask_feature = \
+                precise_char_mask_feature[:, dc_up:dc_down, dc_left:dc_right].contiguous()
+        precise_char_prob_feature = \
+            precise_char_prob_feature[:, dc_up:dc_down, dc_left:dc_right].contiguous()
 
         # Up-left corner.
         # (B, P, 2)
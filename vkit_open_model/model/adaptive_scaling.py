@@ -210,9 +210,10 @@ class AdaptiveScaling(nn.Module):
         precise_name_to_grad: Mapping[str, torch.Tensor],
     ):
         names = sorted(set(rough_name_to_grad) & set(precise_name_to_grad))
+        # NOTE: reshape instead of view since the grads might be in channels_last.
 
         rough_abs_grads = torch.abs(
-            torch.cat([rough_name_to_grad[name].view(-1) for name in names])
+            torch.cat([rough_name_to_grad[name].reshape(-1) for name in names])
         )
         rough_abs_grads_mean = float(torch.mean(rough_abs_grads))
         rough_abs_grads_std = float(torch.std(rough_abs_grads))
@@ -222,7 +223,7 @@ class AdaptiveScaling(nn.Module):
         )
 
         precise_abs_grads = torch.abs(
-            torch.cat([precise_name_to_grad[name].view(-1) for name in names])
+            torch.cat([precise_name_to_grad[name].reshape(-1) for name in names])
         )
         precise_abs_grads_mean = float(torch.mean(precise_abs_grads))
         precise_abs_grads_std = float(torch.std(precise_abs_grads))
@@ -13,6 +13,8 @@ from .metrics import Metrics
 from .opt import (
     batch_to_device,
     device_is_cuda,
+    align_optimizer_state_memory_format,
+    prefetch_batches_to_device,
     enable_cudnn_benchmark,
     enable_cudnn_deterministic,
     setup_seeds,
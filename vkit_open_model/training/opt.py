@@ -9,16 +9,25 @@
 # SSPL distribution, student/academic purposes, hobby projects, internal research
 # projects without external distribution, or other projects where all SSPL
 # obligations can be met. For more information, please see the "LICENSE_SSPL.txt" file.
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Mapping, Iterable
 import random
 
 import torch
 import numpy as np
 
 
-def batch_to_device(batch: Dict[str, Any], device: torch.device):
+def batch_to_device(
+    batch: Dict[str, Any],
+    device: torch.device,
+    key_to_memory_format: Optional[Mapping[str, torch.memory_format]] = None,
+):
+    key_to_memory_format = key_to_memory_format or {}
     return {
-        key: val.to(device, non_blocking=True) if torch.is_tensor(val) else val
+        key: val.to(
+            device,
+            non_blocking=True,
+            memory_format=key_to_memory_format.get(key, torch.preserve_format),
+        ) if torch.is_tensor(val) else val
         for key, val in batch.items()
     }
 
@@ -27,6 +36,73 @@ def device_is_cuda(device: torch.device):
     return (device.type == 'cuda')
 
 
+def align_optimizer_state_memory_format(optimizer: torch.optim.Optimizer):
+    # NOTE: The restored states (e.g., from a checkpoint of a contiguous model) keep their
+    # layout, while the fused/foreach kernels require the same layout as the params
+    # (e.g., channels_last).
+    for param_group in optimizer.param_groups:
+        for param in param_group['params']:
+            state = optimizer.state.get(param)
+            if not state:
+                continue
+            for key, val in state.items():
+                if torch.is_tensor(val) \
+                        and val.is_floating_point() \
+                        and val.shape == param.shape \
+                        and val.stride() != param.stride():
+                    # empty_like preserves the strides of param.
+                    state[key] = torch.empty_like(param, dtype=val.dtype).copy_(val)
+
+
+def prefetch_batches_to_device(
+    # Each batch is a mapping of sub-batches, e.g., {'rough': {...}, 'precise': {...}}.
+    batches: Iterable[Mapping[str, Dict[str, Any]]],
+    device: torch.device,
+    key_to_memory_format: Optional[Mapping[str, torch.memory_format]] = None,
+):
+    if not device_is_cuda(device):
+        for batch in batches:
+            yield {
+                name: batch_to_device(sub_batch, device, key_to_memory_format)
+                for name, sub_batch in batch.items()
+            }
+        return
+
+    # NOTE: Copy the next batch in a dedicated stream to overlap with the compute of
+    # the current batch. Requires the batches to be in pinned memory.
+    copy_stream = torch.cuda.Stream(device)
+
+    def copy_batch(batch: Mapping[str, Dict[str, Any]]):
+        with torch.cuda.stream(copy_stream):  # type: ignore
+            device_batch = {
+                name: batch_to_device(sub_batch, device, key_to_memory_format)
+                for name, sub_batch in batch.items()
+            }
+            copy_event = torch.cuda.Event()
+            copy_event.record(copy_stream)
+        return device_batch, copy_event
+
+    def wait_batch(device_batch: Dict[str, Dict[str, Any]], copy_event: torch.cuda.Event):
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_event(copy_event)
+        for sub_batch in device_batch.values():
+            for val in sub_batch.values():
+                if torch.is_tensor(val):
+                    # Prevent the allocator from reusing the memory too early.
+                    val.record_stream(current_stream)
+        return device_batch
+
+    prev_copied = None
+    for batch in batches:
+        copied = copy_batch(batch)
+        if prev_copied is not None:
+            yield wait_batch(*prev_copied)
+        prev_copied = copied
+
+    if prev_copied is not None:
+        yield wait_batch(*prev_copied)
+
+
 def enable_cudnn_benchmark(device: torch.device):
     if device_is_cuda(device):
         torch.backends.cudnn.benchmark = True  # type: ignore